@@ -1,15 +1,18 @@
 """Support for sending data to a VictoriaMetrics installation."""
-from contextlib import suppress
+import calendar
+from collections import deque
 from datetime import datetime
-import json
+import functools
 import logging
-import queue
 import threading
-from typing import Dict, List, Sequence, Tuple, TypedDict, Union
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import voluptuous as vol
 import requests
+from requests.adapters import HTTPAdapter
 import ciso8601
+import orjson
 
 from homeassistant.const import (
     CONF_URL,
@@ -29,12 +32,29 @@ DEFAULT_URL = "http://localhost:8428"
 DEFAULT_PREFIX = "ha"
 DOMAIN = "victoriametrics"
 
+CONF_FORMAT = "format"
+FORMAT_PROMETHEUS = "prometheus"
+FORMAT_JSON = "json"
+DEFAULT_FORMAT = FORMAT_PROMETHEUS
+
+IMPORT_PATHS = {
+    FORMAT_PROMETHEUS: "/api/v1/import/prometheus",
+    FORMAT_JSON: "/api/v1/import",
+}
+
+# Metrics are buffered and sent in one request when either limit is reached
+BATCH_MAX_BYTES = 1024 * 1024
+BATCH_FLUSH_INTERVAL = 1.0
+
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
             {
                 vol.Optional(CONF_URL, default=DEFAULT_URL): cv.string,
                 vol.Optional(CONF_PREFIX, default=DEFAULT_PREFIX): cv.string,
+                vol.Optional(CONF_FORMAT, default=DEFAULT_FORMAT): vol.In(
+                    list(IMPORT_PATHS)
+                ),
             }
         )
     },
@@ -47,7 +67,7 @@ def setup(hass: HomeAssistant, config: ConfigType) -> bool:
     conf = config[DOMAIN]
     url = conf.get(CONF_URL)
     prefix = conf.get(CONF_PREFIX)
-
+    import_format = conf.get(CONF_FORMAT)
 
     response = requests.get(url, timeout=2)
     if not response.ok:
@@ -55,29 +75,161 @@ def setup(hass: HomeAssistant, config: ConfigType) -> bool:
     else:
         _LOGGER.debug("Connection to VictoriaMetrics possible")
 
-    VictoriaMetricsFeeder(hass, url, prefix)
+    VictoriaMetricsFeeder(hass, url, prefix, import_format)
     return True
 
 
-class Metric(TypedDict):
-    metric: Dict[str, str]
-    values: List[float]
-    timestamps: List[float]
+def _skip(value: Any) -> None:
+    """Mark attribute types that are not sent at all."""
+    return None
+
+
+def _looks_like_iso(value: Any) -> bool:
+    """Cheaply check that the value could be an ISO 8601 date or datetime."""
+    return (
+        isinstance(value, str)
+        and 10 <= len(value) <= 35
+        and value[4] == '-'
+        and value[7] == '-'
+        and value[:4].isdigit()
+    )
+
+
+def _timestamp_ms(value: datetime) -> int:
+    """Convert datetime to milliseconds since epoch without float rounding."""
+    if value.tzinfo is None:
+        # Naive datetimes are in local time, same as datetime.timestamp()
+        value = value.astimezone()
+    return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+
+def _parse_datetime(value: Any) -> Optional[int]:
+    """Convert ISO 8601 string to timestamp, return None for other strings."""
+    if not _looks_like_iso(value):
+        return None
+    try:
+        return _timestamp_ms(ciso8601.parse_datetime(value))
+    except ValueError:
+        return None
+
+
+# Converters of attribute values to numbers keyed by exact attribute type,
+# returning None means the value is sent as a tag
+_HANDLERS: Dict[type, Callable[[Any], Optional[Union[int, float]]]] = {
+    type(None): _skip,
+    list: _skip,
+    dict: _skip,
+    tuple: _skip,
+    datetime: lambda value: value.timestamp(),
+    bool: int,
+    float: lambda value: value,
+    int: lambda value: value,
+    str: _parse_datetime,
+}
+
+
+def _find_handler(value: Any) -> Callable[[Any], Optional[Union[int, float]]]:
+    """Find converter for the value whose exact type is not registered."""
+    for value_type, handler in _HANDLERS.items():
+        if isinstance(value, value_type):
+            return handler
+    return _parse_datetime
+
+
+# Characters that can't be used in metric and label names of the Prometheus
+# format, must be the same as in the import script
+_SANITIZE = str.maketrans({char: '_' for char in ' ;,="{}\\\n'})
+
+
+@functools.lru_cache(maxsize=2048)
+def _sanitize(key: str) -> str:
+    """Make attribute name usable in metric and label names of both formats."""
+    # Attribute names repeat across events, so the result is cached
+    return key.translate(_SANITIZE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _json_name(name: str) -> bytes:
+    """Encode metric name as JSON string, names repeat so it is cached."""
+    return orjson.dumps(name)
+
+
+def _json_lines(
+    name_prefix: str,
+    key_values: List[Tuple[str, Union[int, float]]],
+    tags: List[Tuple[str, Any]],
+    timestamp: int,
+) -> List[bytes]:
+    """Format metrics as JSON lines for /api/v1/import."""
+    # Every line has the same shape with a single value, so it is put together
+    # from pre-encoded parts and only the name and value differ
+    labels = {_sanitize(key): value for key, value in tags}
+    labels.pop('__name__', None)
+    labels_part = b',' + orjson.dumps(labels)[1:-1] if labels else b''
+    timestamps_part = b'],"timestamps":[' + str(timestamp).encode() + b']}'
+
+    metrics: List[bytes] = []
+    for key, value in key_values:
+        metrics.append(
+            b'{"metric":{"__name__":'
+            + _json_name(name_prefix + _sanitize(key))
+            + labels_part
+            + b'},"values":['
+            + orjson.dumps(value)
+            + timestamps_part
+        )
+
+    return metrics
+
+
+_LABEL_VALUE_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+def _prometheus_lines(
+    name_prefix: str,
+    key_values: List[Tuple[str, Union[int, float]]],
+    tags: List[Tuple[str, Any]],
+    timestamp: int,
+) -> List[bytes]:
+    """Format metrics in Prometheus exposition format for /api/v1/import/prometheus."""
+    # Labels and timestamp are the same for all metrics of the event
+    labels = ','.join(
+        f'{_sanitize(key)}="{str(value).translate(_LABEL_VALUE_ESCAPE)}"'
+        for key, value in tags
+    )
+    suffix = f'{{{labels}}} ' if labels else ' '
+    ts = f' {timestamp}'
+
+    metrics: List[bytes] = []
+    for key, value in key_values:
+        metrics.append(f'{name_prefix}{_sanitize(key)}{suffix}{value}{ts}'.encode('utf-8'))
+
+    return metrics
 
 
 class VictoriaMetricsFeeder(threading.Thread):
-    """Feed data to VictoriaMetrics using Graphite protocol."""
+    """Feed data to VictoriaMetrics using its import API."""
 
-    def __init__(self, hass: HomeAssistant, url: str, prefix: str):
+    def __init__(self, hass: HomeAssistant, url: str, prefix: str, import_format: str = DEFAULT_FORMAT):
         """Initialize the feeder."""
         super().__init__(daemon=True)
         self._hass = hass
         self._url = url
+        self._format = import_format
+        self._import_url = f'{url}{IMPORT_PATHS[import_format]}'
+        # Keep the connection to VictoriaMetrics alive between flushes
+        self._session = requests.Session()
+        self._session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=2))
         # rstrip any trailing dots in case they think they need it
         self._prefix = prefix.rstrip(".")
-        self._queue = queue.Queue()
+        # Single producer (event bus) and single consumer (this thread),
+        # deque append/popleft are atomic so a wakeup event is enough
+        self._queue: deque = deque()
+        self._wake = threading.Event()
         self._quit_object = object()
         self._we_started = False
+        # Cheaper to check for every event than is_alive()
+        self._running = False
 
         hass.bus.listen_once(EVENT_HOMEASSISTANT_START, self.start_listen)
         hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, self.shutdown)
@@ -88,124 +240,153 @@ class VictoriaMetricsFeeder(threading.Thread):
         """Start event-processing thread."""
         _LOGGER.debug("Event processing thread started")
         self._we_started = True
+        # Set before the thread starts so events queued meanwhile aren't refused
+        self._running = True
         self.start()
 
     def shutdown(self, event):
         """Signal shutdown of processing event."""
         _LOGGER.debug("Event processing signaled exit")
-        self._queue.put(self._quit_object)
+        self._queue.append(self._quit_object)
+        self._wake.set()
 
     def event_listener(self, event):
         """Queue an event for processing."""
-        if self.is_alive() or not self._we_started:
+        if self._running or not self._we_started:
             _LOGGER.debug("Received event")
-            self._queue.put(event)
+            self._queue.append(event)
+            self._wake.set()
         else:
             _LOGGER.error("VictoriaMetrics feeder thread has died, not queuing event")
 
-    def _send_to_victoriametrics(self, metrics: Sequence[str]):
-        """Send data to VictoriaMetrics using Graphite protocol."""
-        response = requests.post(f'{self._url}/api/v1/import', data='\n'.join(metrics).encode('utf-8'), timeout=5)
+    def _send_to_victoriametrics(self, data: Union[bytes, bytearray]):
+        """Send data to VictoriaMetrics import API."""
+        response = self._session.post(self._import_url, data=data, timeout=5)
         if response.ok:
-            _LOGGER.debug('%d metrics successfully sent to victoriametrics', len(metrics))
+            _LOGGER.debug('%d bytes of metrics successfully sent to victoriametrics', len(data))
         else:
             _LOGGER.error('Unable to send metrics to victoriametrics: %d %s', response.status_code, response.content)
 
-    def _report_event(self, event: Event):
-        #entity_id, new_state
-        """Report the event."""
+    def _flush(self, buffer: bytearray):
+        """Send buffered metrics and empty the buffer."""
+        if not buffer:
+            return
+        try:
+            # Send the buffer as is, it is only cleared after the request is done
+            self._send_to_victoriametrics(buffer)
+        except Exception:  # pylint: disable=broad-except
+            # Catch this so we can avoid the thread dying and
+            # make it visible.
+            _LOGGER.exception("Failed to send metrics to victoriametrics")
+        buffer.clear()
+
+    def _build_metrics(self, event: Event) -> List[bytes]:
+        """Build lines with metrics for the event in the configured format."""
         entity_id = event.data['entity_id']
         new_state: State = event.data['new_state']
 
-        things = dict(new_state.attributes)
-
-        with suppress(ValueError):
-            things['value'] = state.state_as_number(new_state)
+        try:
+            state_value = state.state_as_number(new_state)
+        except ValueError:
+            state_value = None
 
         key_values: List[Tuple[str, Union[int, float]]] = []
         tags = []
-        for key, value in things.items():
-            num_value = None
-            if value is None:
-                continue
-            elif isinstance(value, list):
-                continue
-            elif isinstance(value, dict):
+        for key, value in new_state.attributes.items():
+            if key == 'value' and state_value is not None:
+                # Numeric state takes precedence over attribute with the same name
                 continue
-            elif isinstance(value, tuple):
+
+            handler = _HANDLERS.get(type(value))
+            if handler is None:
+                handler = _find_handler(value)
+            if handler is _skip:
                 continue
-            elif isinstance(value, datetime):
-                num_value = value.timestamp()
-            elif isinstance(value, bool):
-                num_value = int(value)
-            elif isinstance(value, (float, int)):
-                num_value = value
-            else:
-                try:
-                    num_value = ciso8601.parse_datetime(value).timestamp() * 1000
-                except ValueError:
-                    num_value = None
 
+            num_value = handler(value)
             if num_value is not None:
                 key_values.append((key, num_value))
             else:
                 tags.append((key, value))
 
+        if state_value is not None:
+            key_values.append(('value', state_value))
+
         if not key_values:
             # If there is no numeric state, use 0 so we at least post attributes
             key_values.append(('value', 0))
             tags.append(('value', new_state.state))
 
-        metrics: List[str] = []
-
-        for key, value in key_values:
-            metric_name = f'{self._prefix}.{entity_id}.{key.replace(" ", "_")}'
+        name_prefix = f'{self._prefix}.{entity_id}.'
+        timestamp = int(event.time_fired.timestamp() * 1000)
+        if self._format == FORMAT_PROMETHEUS:
+            metrics = _prometheus_lines(name_prefix, key_values, tags, timestamp)
+        else:
+            metrics = _json_lines(name_prefix, key_values, tags, timestamp)
 
-            metric: Metric = {
-                'metric': {
-                    '__name__': metric_name,
-                },
-                'values': [value],
-                'timestamps': [int(event.time_fired.timestamp() * 1000)],
-            }
-            for tag_key, tag_value in tags:
-                metric['metric'][tag_key] = tag_value
+        # Joining the metrics is expensive, only do it when it's going to be logged
+        if metrics and _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Metrics for victoriametrics:\n%s\n\t", b'\n\t'.join(metrics).decode('utf-8'))
+        return metrics
 
-            metrics.append(json.dumps(metric, indent=None))
+    def _process_event(self, event: Event, buffer: bytearray):
+        """Append metrics for the event to the buffer."""
+        if event.event_type != EVENT_STATE_CHANGED:
+            _LOGGER.warning("Processing unexpected event type %s", event.event_type)
+            return
 
-        if not metrics:
+        if not event.data.get("new_state"):
+            _LOGGER.debug(
+                "Skipping %s without new_state for %s",
+                event.event_type,
+                event.data["entity_id"],
+            )
             return
 
-        _LOGGER.debug("Sending to victoriametrics:\n%s\n\t", '\n\t'.join(metrics))
-        self._send_to_victoriametrics(metrics)
+        _LOGGER.debug(
+            "Processing STATE_CHANGED event for %s", event.data["entity_id"]
+        )
+        try:
+            for metric in self._build_metrics(event):
+                buffer += metric
+                buffer += b'\n'
+        except Exception:  # pylint: disable=broad-except
+            # Catch this so we can avoid the thread dying and
+            # make it visible.
+            _LOGGER.exception("Failed to process STATE_CHANGED event")
 
     def run(self):
         """Run the process to export the data."""
+        try:
+            self._export()
+        finally:
+            self._running = False
+
+    def _export(self):
+        """Process queued events until shutdown."""
+        buffer = bytearray()
+        last_flush = time.monotonic()
         while True:
-            if (event := self._queue.get()) == self._quit_object:
-                _LOGGER.debug("Event processing thread stopped")
-                self._queue.task_done()
-                return
-            if event.event_type == EVENT_STATE_CHANGED:
-                if not event.data.get("new_state"):
-                    _LOGGER.debug(
-                        "Skipping %s without new_state for %s",
-                        event.event_type,
-                        event.data["entity_id"],
-                    )
-                    self._queue.task_done()
-                    continue
-
-                _LOGGER.debug(
-                    "Processing STATE_CHANGED event for %s", event.data["entity_id"]
-                )
-                try:
-                    self._report_event(event)
-                except Exception:  # pylint: disable=broad-except
-                    # Catch this so we can avoid the thread dying and
-                    # make it visible.
-                    _LOGGER.exception("Failed to process STATE_CHANGED event")
+            if buffer:
+                timeout = last_flush + BATCH_FLUSH_INTERVAL - time.monotonic()
+                self._wake.wait(max(timeout, 0))
             else:
-                _LOGGER.warning("Processing unexpected event type %s", event.event_type)
-
-            self._queue.task_done()
+                self._wake.wait()
+            self._wake.clear()
+
+            while self._queue:
+                event = self._queue.popleft()
+                if event is self._quit_object:
+                    self._flush(buffer)
+                    self._session.close()
+                    _LOGGER.debug("Event processing thread stopped")
+                    return
+
+                self._process_event(event, buffer)
+                if len(buffer) >= BATCH_MAX_BYTES:
+                    self._flush(buffer)
+                    last_flush = time.monotonic()
+
+            if time.monotonic() - last_flush >= BATCH_FLUSH_INTERVAL:
+                self._flush(buffer)
+                last_flush = time.monotonic()
@@ -1,9 +1,9 @@
-import io
+import logging
 import sys
 import asyncio
-from collections import defaultdict
-import orjson
-from typing import Dict, List, Optional, Tuple, Union
+import calendar
+import functools
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Set, Tuple, Union
 import zoneinfo
 from datetime import datetime
 
@@ -12,48 +12,109 @@ try:
 except ModuleNotFoundError:
     import tomli as tomllib
 
-import dateutil.parser
+try:
+    from isal import isal_zlib
+except ModuleNotFoundError:
+    isal_zlib = None
+
+import aiohttp
+import ciso8601
 
 from .base import InputBase, OutputBase
 from .influx import Influx
-from .victoria import Metric, Victoria
+from .victoria import Victoria
+
+_LOGGER = logging.getLogger(__name__)
+
+# Size of chunks of the body streamed to the output
+STREAM_CHUNK_SIZE = 256 * 1024
 
 utc = zoneinfo.ZoneInfo('UTC')
 local = zoneinfo.ZoneInfo('Europe/Prague')
 
 
+# Characters that can't be used in metric and label names of the Prometheus
+# format, must be the same as in the feeder so imported series match live ones
+SANITIZE_TABLE = str.maketrans({char: '_' for char in ' ;,="{}\\\n'})
+
+
+@functools.lru_cache(maxsize=2048)
+def sanitize_key(key: str) -> str:
+    return key.translate(SANITIZE_TABLE)
+
+
 def transform_tag(tag: str):
     if tag == '_measurement':
         return 'unit_of_measurement'
     return tag.removesuffix('_str')
 
 
-def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
-    """
-    Lets you use an iterable (e.g. a generator) that yields bytestrings as a read-only
-    input stream.
-
-    The stream implements Python 3's newer I/O API (available in Python 2's io module).
-    For efficiency, the stream is buffered.
-    """
-    class IterStream(io.RawIOBase):
-        def __init__(self):
-            self.leftover: Optional[bytes] = None
-
-        def readable(self):
-            return True
+# Kinds of columns in Influx CSV export, resolved once per header row
+COLUMN_TIME, COLUMN_DOMAIN, COLUMN_ENTITY_ID, COLUMN_DOUBLE, COLUMN_STATE, COLUMN_TAG = range(6)
+
+# (index, kind, header, tag key or None when the tag is blacklisted)
+ColumnPlan = List[Tuple[int, int, str, Optional[str]]]
+
+
+def plan_columns(headers: List[str], datatypes: List[str], blacklist_tags: Set[str]) -> ColumnPlan:
+    plan: ColumnPlan = []
+    for i, header in enumerate(headers):
+        if header in ('', 'result', 'table'):
+            continue
+        elif header == '_time':
+            kind = COLUMN_TIME
+        elif header == 'domain':
+            kind = COLUMN_DOMAIN
+        elif header == 'entity_id':
+            kind = COLUMN_ENTITY_ID
+        elif datatypes[i] == 'double':
+            kind = COLUMN_DOUBLE
+        elif header == 'state':
+            kind = COLUMN_STATE
+        else:
+            kind = COLUMN_TAG
+
+        key = transform_tag(header)
+        plan.append((i, kind, header, None if key in blacklist_tags else sanitize_key(key)))
+    return plan
+
+
+def parse_row(plan: ColumnPlan, entry: List[str]) -> Tuple[
+    List[Tuple[str, Union[int, float]]], Dict[str, str], Optional[str], Optional[str], Optional[int]
+]:
+    key_values: List[Tuple[str, Union[int, float]]] = []
+    tags: Dict[str, str] = {}
+    domain = None
+    entity_id = None
+    timestamp = None
+
+    for i, kind, header, key in plan:
+        value = entry[i]
+        if kind == COLUMN_DOUBLE and value != '':
+            key_values.append((header, float(value)))
+            continue
+        elif kind == COLUMN_TIME:
+            dt = ciso8601.parse_datetime(value)
+            timestamp = calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+            continue
+        elif kind == COLUMN_DOMAIN:
+            domain = value
+            continue
+        elif kind == COLUMN_ENTITY_ID:
+            entity_id = value
+            continue
+        elif kind == COLUMN_STATE:
+            if value.lower() in ('zapnuto', 'zap', 'on'):
+                key_values.append(('value', 1))
+                continue
+            elif value.lower() in ('vypnuto', 'vyp', 'off'):
+                key_values.append(('value', 0))
+                continue
 
-        def readinto(self, b):
-            try:
-                l = len(b)  # We're supposed to return at most this much
-                chunk: bytes = self.leftover or next(iterable)
-                output, self.leftover = chunk[:l], chunk[l:]
-                b[:len(output)] = output
-                return len(output)
-            except StopIteration:
-                return 0    # indicate EOF
+        if key is not None:
+            tags[key] = value
 
-    return io.BufferedReader(IterStream(), buffer_size=buffer_size)
+    return key_values, tags, domain, entity_id, timestamp
 
 
 class Importer:
@@ -65,82 +126,57 @@ class Importer:
         self.blacklist_entities = set(self.config.get('blacklist_entities', None) or [])
         self.whitelist_entities = self.config.get('whitelist_entities', None) or []
         self.blacklist_tags = set(self.config.get('blacklist_tags', None) or [])
+        # Number of Flux queries running at the same time
+        self.concurrency = self.config.get('concurrency', None) or 8
+        # Number of entities exported by a single Flux query
+        self.entities_per_query = self.config.get('entities_per_query', None) or 50
 
     async def generate(self, start: datetime, end: datetime, prefix: str):
-        print('Fetching unique entities from input')
+        _LOGGER.info('Fetching unique entities from input')
 
         if self.whitelist_entities:
             entities = self.whitelist_entities
         else:
             entities = [e async for e in self.input.get_unique_entities(start, end)]
 
+        batch: List[str] = []
         for entity in entities:
             if entity in self.blacklist_entities:
-                print(f'Entity {entity} skipped')
+                _LOGGER.info('Entity %s skipped', entity)
                 continue
 
-            print('Processing INFLUX entity', entity)
+            batch.append(entity)
+            if len(batch) >= self.entities_per_query:
+                yield batch, functools.partial(self.export_entities, batch, start, end, prefix)
+                batch = []
+
+        if batch:
+            yield batch, functools.partial(self.export_entities, batch, start, end, prefix)
 
-            datatypes = None
-            headers = None
+    async def export_entities(self, entities: List[str], start: datetime, end: datetime, prefix: str) -> AsyncGenerator[bytearray, None]:
+        """
+        Stream lines for the entities in output's format, in chunks of about STREAM_CHUNK_SIZE.
 
-            metrics: Dict[str, Metric] = defaultdict(lambda: {
-                'metric': {
-                    '__name__': '',
-                },
-                'values': [],
-                'timestamps': [],
-            })
+        Samples are not merged into series, victoriametrics accepts the same
+        metric on multiple lines, so memory use doesn't grow with the time range.
+        """
+        datatypes = None
+        plan = None
 
-            async for entry in self.input.export_entity(entity, start, end):
+        buffer = bytearray()
+        async for entries in self.input.export_entities(entities, start, end):
+            for entry in entries:
                 if len(entry) <= 1:
                     continue
                 elif entry[0] == '#datatype':
                     datatypes = entry
                 elif entry[1] == 'result':
-                    headers = entry
-                else: # data
                     assert datatypes
-                    assert headers
-
-                    key_values: List[Tuple[str, Union[float, None]]] = []
-                    tags: Dict[str, str] = {}
-                    domain = None
-                    entity_id = None
-                    timestamp = None
-
-                    for i, value in enumerate(entry):
-                        datatype = datatypes[i]
-                        header = headers[i]
-                        if header in ['', 'result', 'table']:
-                            continue
-                        elif header == '_time':
-                            dt = dateutil.parser.isoparse(value)
-                            timestamp = int(dt.timestamp() * 1000)
-                        elif header == 'domain':
-                            domain = value
-                        elif header == 'entity_id':
-                            entity_id = value
-                        elif datatype == 'double' and value != '':
-                            float_value = float(value)
-
-                            if header == 'value':
-                                key_values.append(('value', float_value))
-                            else:
-                                key_values.append((header, float_value))
-                        else:
-                            if header == 'state':
-                                if value.lower() in ('zapnuto', 'zap', 'on'):
-                                    key_values.append(('value', 1))
-                                    continue
-                                elif value.lower() in ('vypnuto', 'vyp', 'off'):
-                                    key_values.append(('value', 0))
-                                    continue
-
-                            key = transform_tag(header)
-                            if key in self.blacklist_tags:
-                                continue
-                            tags[key] = value
+                    plan = plan_columns(entry, datatypes, self.blacklist_tags)
+                else: # data
+                    assert plan
+
+                    key_values, tags, domain, entity_id, timestamp = parse_row(plan, entry)
 
                     if not key_values:
                         # If there is no numeric state, use 0 so we at least post attributes
@@ -150,25 +186,45 @@ class Importer:
                     assert entity_id
                     assert timestamp
 
-                    for key, value in key_values:
-                        metric_name = f'{prefix}.{domain}.{entity_id}.{key.replace(" ", "_")}'
-                        tag = ';'.join(f'{k}={v}' for k, v in tags.items())
-                        metric_with_tags = f'{metric_name};{tag}'
-                        metric = metrics[metric_with_tags]
-                        metric['metric']['__name__'] = metric_name
-                        metric['values'].append(value)
-                        metric['timestamps'].append(timestamp)
-
-                        for tag_key, tag_value in tags.items():
-                            metric['metric'][tag_key] = tag_value
+                    name_prefix = f'{prefix}.{domain}.{entity_id}.'
+                    samples = [(name_prefix + sanitize_key(key), value) for key, value in key_values]
+                    for line in self.output.format_row(samples, tags, timestamp):
+                        buffer += line
+                        buffer += b'\n'
 
-            yield iterable_to_stream(orjson.dumps(metric) + b'\n' for metric in metrics.values())
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                # Hand over the buffer itself instead of a copy and start a new one
+                yield buffer
+                buffer = bytearray()
 
-            print('DONE')
+        if buffer:
+            yield buffer
 
     async def process(self, start: datetime, end: datetime, prefix: str):
-        async for jsonl in self.generate(start, end, prefix):
-            await self.output.import_data(jsonl)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def import_entities(entities: List[str], jsonl: Callable[[], AsyncGenerator[bytes, None]]):
+            async with semaphore:
+                _LOGGER.info('Processing INFLUX entities %s', ', '.join(entities))
+                await self.output.import_data(jsonl)
+                _LOGGER.info('Entities %s done', ', '.join(entities))
+
+        await asyncio.gather(*[
+            import_entities(entities, jsonl)
+            async for entities, jsonl in self.generate(start, end, prefix)
+        ])
+
+
+async def run_import(config: dict, start: datetime, end: datetime, prefix: str):
+    # Single session shared by input and output so connections are kept alive
+    # and reused across all entities
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=16, keepalive_timeout=30, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        input = Influx(session, **config['input'])
+        output = Victoria(session, **config['output'])
+
+        importer = Importer(config, input, output)
+        await importer.process(start, end, prefix)
 
 
 
@@ -177,6 +233,8 @@ if __name__ == '__main__':
         print(f'Usage: {sys.argv[0]} config.toml')
         sys.exit(1)
 
+    logging.basicConfig(level=logging.INFO)
+
     with open(sys.argv[1], 'rb') as f:
         config = tomllib.load(f)
 
@@ -185,9 +243,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     input_type = config['input'].pop('type')
-    if input_type == 'influxV2':
-        input = Influx(**config['input'])
-    else:
+    if input_type != 'influxV2':
         print('Invalid input type, only "influxV2" is supported', file=sys.stderr)
         sys.exit(1)
 
@@ -196,9 +252,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     output_type = config['output'].pop('type')
-    if output_type == 'victoriametrics':
-        output = Victoria(**config['output'])
-    else:
+    if output_type != 'victoriametrics':
         print('Invalid output type, only "victoriametrics" is supported', file=sys.stderr)
         sys.exit(1)
 
@@ -207,7 +261,9 @@ if __name__ == '__main__':
     if end == 'now':
         end = datetime.now(tz=zoneinfo.ZoneInfo('UTC'))
 
-    importer = Importer(config, input, output)
+    if isal_zlib is not None:
+        # Decompress gzipped Influx responses with SIMD optimized ISA-L
+        aiohttp.set_zlib_backend(isal_zlib)
 
-    asyncio.run(importer.process(start, end, prefix=config.get('prefix') or 'ha'))
+    asyncio.run(run_import(config, start, end, prefix=config.get('prefix') or 'ha'))
 
@@ -1,7 +1,6 @@
 
 from datetime import datetime
-import io
-from typing import AsyncGenerator, Generator, List, Sequence
+from typing import AsyncGenerator, AsyncIterable, Callable, Dict, Generator, List, Sequence, Tuple, Union
 
 
 class InputBase:
@@ -9,11 +8,17 @@ class InputBase:
         raise NotImplementedError()
         yield ''
 
-    async def export_entity(self, entity: str, start: datetime, end: datetime) -> AsyncGenerator[List[str], None]:
+    async def export_entities(self, entities: List[str], start: datetime, end: datetime) -> AsyncGenerator[List[List[str]], None]:
+        """Yield exported CSV rows of all the entities in batches."""
         raise NotImplementedError()
         yield []
 
 
 class OutputBase:
-    async def import_data(self, metrics: io.BufferedReader):
+    def format_row(self, samples: List[Tuple[str, Union[int, float]]], tags: Dict[str, str], timestamp: int) -> List[bytes]:
+        """Format samples with the same tags and timestamp as lines for import_data."""
+        raise NotImplementedError()
+
+    async def import_data(self, metrics: Callable[[], AsyncIterable[bytes]]):
+        """Import data from the stream returned by metrics, it can be called again to retry."""
         raise NotImplementedError()
@@ -1,60 +1,172 @@
 
+import codecs
+from collections import deque
 import csv
+import logging
+import string
+from typing import AsyncGenerator, List, Tuple
 
 import aiohttp
+import orjson
 
 from .base import InputBase
 
 
-class Influx(InputBase):
-    def __init__(self, url: str, org_id: str, token: str, bucket: str):
-        self.url = url
-        self.org_id = org_id
-        self.token = token
-        self.bucket = bucket
+_LOGGER = logging.getLogger(__name__)
 
-    async def get_unique_entities(self, start, end):
-        query = f'''
-from(bucket: "homeassistant")
-    |> range(start: {start.isoformat()}, stop: {end.isoformat()})
+# Number of CSV rows yielded at once
+BATCH_SIZE = 1000
+
+# Size of chunks read from Influx responses
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class LineFeed:
+    """
+    Iterator of lines for a long-lived csv.reader that is refilled as data arrive.
+
+    Data are fed in arbitrary chunks, only complete records are passed to the reader.
+    Lines keep their terminators and lines of a quoted field containing newlines
+    are passed together, so the reader sees the field as it was sent.
+    When it runs out of lines, the reader stops iterating but it can be resumed
+    after more data are fed.
+    """
+    def __init__(self, skip_prefixes: Tuple[str, ...] = ()):
+        self.lines: deque = deque()
+        self.tail = ''
+        # Complete lines of a record whose quoted field isn't closed yet
+        self.record = ''
+        self.quoted = False
+        # Whole chunks are decoded at once, multi-byte characters split between
+        # chunks are kept by the decoder until the rest arrives
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # Lines that the consumer doesn't need are dropped before they're parsed
+        self.skip_prefixes = skip_prefixes
+
+    def feed(self, chunk: bytes):
+        *complete, self.tail = (self.tail + self.decoder.decode(chunk)).split('\n')
+        for line in complete:
+            # Escaped quotes are doubled, so only odd count opens or closes a field
+            if line.count('"') % 2:
+                self.quoted = not self.quoted
+            if self.quoted:
+                self.record += line + '\n'
+            elif self.record:
+                self.append(self.record + line + '\n')
+                self.record = ''
+            else:
+                self.append(line + '\n')
+
+    def close(self):
+        self.append(self.record + self.tail + self.decoder.decode(b'', final=True))
+        self.record = ''
+        self.tail = ''
+
+    def append(self, line: str):
+        if self.wanted(line):
+            self.lines.append(line)
+
+    def wanted(self, line: str) -> bool:
+        return line not in ('', '\n', '\r\n') and not line.startswith(self.skip_prefixes)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+# Flux queries, bucket is filled in once per Influx instance and the rest per call
+UNIQUE_ENTITIES_QUERY = string.Template('''
+from(bucket: "$bucket")
+    |> range(start: $start, stop: $stop)
     |> keep(columns: ["entity_id"])
     |> unique(column: "entity_id")
-'''
-        async for row in self.get_data({
-            'query': query,
-        }):
-            if len(row) == 4 and row[3] != 'entity_id':
-                yield row[3]
-
-    async def export_entity(self, entity, start, end):
-        query = f'''
-from(bucket: "{self.bucket}")
-    |> range(start: {start.isoformat()}, stop: {end.isoformat()})
-    |> filter(fn: (r) => r["entity_id"] == "{entity}")
+''')
+
+EXPORT_ENTITIES_QUERY = string.Template('''
+from(bucket: "$bucket")
+    |> range(start: $start, stop: $stop)
+    |> filter(fn: (r) => $entity_filter)
+    |> drop(columns: ["_start", "_stop"])
     |> pivot(
         rowKey: ["_time"],
         columnKey: ["_field"],
         valueColumn: "_value"
     )
-    |> drop(columns: ["_start", "_stop"])
-'''
-        print(query)
-        async for row in self.get_data({
+''')
+
+
+def escape_flux_string(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${')
+
+
+def bind_template(template: string.Template, **values: str) -> string.Template:
+    # Escape "$" so the substituted values are not treated as placeholders later
+    return string.Template(template.safe_substitute({
+        key: value.replace('$', '$$') for key, value in values.items()
+    }))
+
+
+class Influx(InputBase):
+    def __init__(self, session: aiohttp.ClientSession, url: str, org_id: str, token: str, bucket: str):
+        self.session = session
+        self.url = url
+        self.org_id = org_id
+        self.token = token
+        self.bucket = bucket
+
+        bucket = escape_flux_string(bucket)
+        self._unique_entities_query = bind_template(UNIQUE_ENTITIES_QUERY, bucket=bucket)
+        self._export_entities_query = bind_template(EXPORT_ENTITIES_QUERY, bucket=bucket)
+
+    async def get_unique_entities(self, start, end):
+        query = self._unique_entities_query.substitute(start=start.isoformat(), stop=end.isoformat())
+        # Only data rows are needed, not the annotations and table headers
+        async for rows in self.get_data({
+            'query': query,
+        }, skip_prefixes=('#', ',result,')):
+            for row in rows:
+                if len(row) == 4 and row[3] != 'entity_id':
+                    yield row[3]
+
+    async def export_entities(self, entities, start, end):
+        # Comparisons joined with "or" are pushed down to the storage unlike contains()
+        entity_filter = ' or '.join(f'r["entity_id"] == "{escape_flux_string(entity)}"' for entity in entities)
+        query = self._export_entities_query.substitute(
+            start=start.isoformat(),
+            stop=end.isoformat(),
+            entity_filter=entity_filter,
+        )
+        _LOGGER.debug('Flux query: %s', query)
+        async for rows in self.get_data({
             'query': query,
             'dialect': {
                 'annotations': ['datatype'],
             },
         }):
-            yield row
-
-    async def get_data(self, query: dict):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.url}/api/v2/query?orgID={self.org_id}', headers={
-                'Authorization': f'Token {self.token}',
-                'Content-Type': 'application/json',
-                'Accept-Encoding': 'gzip',
-            }, json=query) as response:
-                response.raise_for_status()
-                async for line in response.content:
-                    parsed_line = next(csv.reader([line.decode('utf-8')]))
-                    yield parsed_line
+            yield rows
+
+    async def get_data(self, query: dict, skip_prefixes: Tuple[str, ...] = ()) -> AsyncGenerator[List[List[str]], None]:
+        async with self.session.post(f'{self.url}/api/v2/query?orgID={self.org_id}', headers={
+            'Authorization': f'Token {self.token}',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+        }, data=orjson.dumps(query)) as response:
+            response.raise_for_status()
+            lines = LineFeed(skip_prefixes)
+            reader = csv.reader(lines)
+            rows = []
+            # Read large chunks instead of awaiting every line
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                lines.feed(chunk)
+                rows.extend(reader)
+                if len(rows) >= BATCH_SIZE:
+                    yield rows
+                    rows = []
+            lines.close()
+            rows.extend(reader)
+            if rows:
+                yield rows
@@ -1,12 +1,21 @@
 import asyncio
 import csv
-import io
-from typing import Dict, Generator, List, TypedDict, Union
+import logging
+from typing import AsyncIterable, Callable, Dict, Generator, List, Optional, Tuple, TypedDict, Union
 
 import aiohttp
+import orjson
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+try:
+    from isal import isal_zlib as zlib
+except ModuleNotFoundError:
+    import zlib
 
 from .base import OutputBase
 
+_LOGGER = logging.getLogger(__name__)
+
 
 def parse_line(line: str) -> list:
     return next(csv.reader([line]))
@@ -18,30 +27,119 @@ class Metric(TypedDict):
     timestamps: List[int]
 
 
+FORMAT_PROMETHEUS = 'prometheus'
+FORMAT_JSON = 'json'
+
+# Import endpoint and content type for each format
+IMPORT_FORMATS = {
+    FORMAT_PROMETHEUS: ('/api/v1/import/prometheus', 'text/plain'),
+    FORMAT_JSON: ('/api/v1/import', 'jsonl'),
+}
+
+LABEL_VALUE_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+def format_json(samples: List[Tuple[str, Union[int, float]]], tags: Dict[str, str], timestamp: int) -> List[bytes]:
+    labels = {'__name__': '', **tags}
+    values: List[Union[int, float, None]] = [None]
+    metric: Metric = {
+        'metric': labels,
+        'values': values,
+        'timestamps': [timestamp],
+    }
+
+    lines = []
+    for name, value in samples:
+        labels['__name__'] = name
+        values[0] = value
+        lines.append(orjson.dumps(metric))
+    return lines
+
+
+def format_prometheus(samples: List[Tuple[str, Union[int, float]]], tags: Dict[str, str], timestamp: int) -> List[bytes]:
+    labels = ','.join(f'{key}="{value.translate(LABEL_VALUE_ESCAPE)}"' for key, value in tags.items())
+    suffix = f'{{{labels}}} ' if labels else ' '
+    return [f'{name}{suffix}{value} {timestamp}'.encode('utf-8') for name, value in samples]
+
+
+async def gzip_stream(chunks: AsyncIterable[bytes]) -> AsyncIterable[bytes]:
+    # Fastest level, the data compresses well anyway and sending is usually
+    # what's limiting
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Responses meaning victoriametrics can't keep up with the ingest
+OVERLOAD_STATUSES = (429, 503)
+
+
+class AdaptiveLimit:
+    """
+    Limits number of concurrent requests, the limit is halved when the server
+    is overloaded and grows back by one with every successful request.
+    """
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, status: Optional[int]):
+        """Release the request with status of its response, None when there's no response."""
+        async with self.condition:
+            self.active -= 1
+            if status in OVERLOAD_STATUSES:
+                self.limit = max(1, self.limit // 2)
+                _LOGGER.info('Victoriametrics is overloaded, limiting concurrent imports to %d', self.limit)
+            elif status is not None and 200 <= status < 300 and self.limit < self.maximum:
+                self.limit += 1
+            self.condition.notify_all()
+
+
 class Victoria(OutputBase):
     MAX_ATTEMPTS = 3
-    def __init__(self, url: str):
+    def __init__(self, session: aiohttp.ClientSession, url: str, format: str = FORMAT_PROMETHEUS, import_concurrency: int = 8):
+        if format not in IMPORT_FORMATS:
+            raise ValueError(f'Invalid format "{format}", use one of: {", ".join(IMPORT_FORMATS)}')
+        self.session = session
         self.url = url
+        self.import_path, self.content_type = IMPORT_FORMATS[format]
+        self.format_row = format_json if format == FORMAT_JSON else format_prometheus
+        self.limit = AdaptiveLimit(import_concurrency)
 
-    async def import_data(self, metrics: io.BufferedReader):
-        for attempt in range(1, self.MAX_ATTEMPTS + 1):
-            async with aiohttp.ClientSession() as session:
+    async def import_data(self, metrics: Callable[[], AsyncIterable[bytes]]):
+        # Streamed body can't be sent again, so every attempt asks for a new one
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(self.MAX_ATTEMPTS),
+            wait=wait_random_exponential(multiplier=2, max=30),
+            retry=retry_if_exception_type(aiohttp.ClientError),
+            before_sleep=self._log_retry,
+            reraise=True,
+        ):
+            with attempt:
+                await self.limit.acquire()
+                status = None
                 try:
-                    response = await session.post(f'{self.url}/api/v1/import', data=metrics, headers={ 'Content-Type': 'jsonl' })
-                except aiohttp.ClientError:
-                    print(f'{attempt}/{self.MAX_ATTEMPTS} Cannot connect to victoriametrics')
-                    if attempt < self.MAX_ATTEMPTS:
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-                    else:
-                        raise
-                else:
-                    if not response.ok:
-                        print(f'{attempt}/{self.MAX_ATTEMPTS} Cannot send data to victoriametrics, status {response.status}')
-                        if attempt < self.MAX_ATTEMPTS:
-                            await asyncio.sleep(2 ** attempt)
-                            continue
-                        else:
-                            response.raise_for_status()
-                    else:
-                        break
+                    async with self.session.post(f'{self.url}{self.import_path}', data=gzip_stream(metrics()), headers={
+                        'Content-Type': self.content_type,
+                        'Content-Encoding': 'gzip',
+                    }) as response:
+                        status = response.status
+                        response.raise_for_status()
+                finally:
+                    await self.limit.release(status)
+
+    def _log_retry(self, retry_state: RetryCallState):
+        _LOGGER.warning(
+            '%d/%d Cannot send data to victoriametrics: %s',
+            retry_state.attempt_number, self.MAX_ATTEMPTS, retry_state.outcome.exception(),
+        )